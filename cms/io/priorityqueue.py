@@ -315,6 +315,29 @@ class PriorityQueue(object):
             self._event.clear()
         return top
 
+    def pop_all(self, wait=False):
+        """Extract (and return) all the elements in the queue.
+
+        This is equivalent to calling pop until the queue is empty,
+        but avoids rebalancing the heap after each extraction.
+
+        wait (bool): if True, block until an element is present.
+
+        return ([QueueEntry]): all the elements in the queue, sorted
+            from the first to the last.
+
+        raise (LookupError): on empty queue, if wait was false.
+
+        """
+        self.top(wait)
+        entries = sorted(self._queue)
+
+        self._queue = []
+        self._reverse = {}
+        # Signal that there is nothing left for listeners.
+        self._event.clear()
+        return entries
+
     def remove(self, item):
         """Remove an item from the queue. Raise a KeyError if not present.
 
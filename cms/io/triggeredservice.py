@@ -127,10 +127,13 @@ class Executor(with_metaclass(ABCMeta, object)):  # pylint: disable=R0921
             to_execute = [self._operation_queue.pop(wait=True)]
             if self._batch_executions:
                 max_operations = self.max_operations_per_batch()
-                while not self._operation_queue.empty() and (
-                        max_operations == 0 or
-                        len(to_execute) < max_operations):
-                    to_execute.append(self._operation_queue.pop())
+                if max_operations == 0:
+                    if not self._operation_queue.empty():
+                        to_execute.extend(self._operation_queue.pop_all())
+                else:
+                    while not self._operation_queue.empty() and \
+                            len(to_execute) < max_operations:
+                        to_execute.append(self._operation_queue.pop())
 
             assert len(to_execute) > 0, "Expected at least one element."
             if self._batch_executions:
@@ -34,22 +34,24 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
+from six import iteritems
 
 import json
 import logging
 import string
+from collections import OrderedDict
 from future.moves.urllib.parse import urljoin, urlsplit
 
 import gevent
-import gevent.queue
 import requests
 import requests.exceptions
 from sqlalchemy import not_
+from sqlalchemy.orm import contains_eager, joinedload, subqueryload
 
 from cms import config
 from cms.io import Executor, QueueItem, TriggeredService, rpc_method
-from cms.db import SessionGen, Contest, Participation, Task, Submission, \
-    get_submissions
+from cms.db import SessionGen, Contest, Dataset, Participation, Task, \
+    Submission, SubmissionResult, Token, get_submissions
 from cmscommon.datetime import make_timestamp
 
 
@@ -60,6 +62,45 @@ class CannotSendError(Exception):
     pass
 
 
+class DataRejectedError(CannotSendError):
+    """The ranking refused the data as invalid (status 400 or 422).
+
+    Sending the same data again would be refused again. Other errors
+    (e.g., 401 for wrong credentials, 404 for a wrong URL, or those of
+    a proxy in front of the ranking) raise CannotSendError instead, as
+    the data could be accepted once the problem is fixed.
+
+    """
+    pass
+
+
+class _EncodeTable(dict):
+    """Translation table (for unicode.translate) used by encode_id.
+
+    Letters and digits are kept, every other character is replaced by
+    an underscore followed by its code point in hexadecimal. Entries
+    are computed (and stored) the first time they are needed.
+
+    """
+
+    SAFE_CHARS = frozenset(string.ascii_letters + string.digits)
+
+    def __missing__(self, code_point):
+        char = chr(code_point)
+        encoded_char = char if char in self.SAFE_CHARS \
+            else "_%x" % code_point
+        self[code_point] = encoded_char
+        return encoded_char
+
+
+_ENCODE_TABLE = _EncodeTable()
+
+# The results of encode_id, as the same few ids (contest, users, teams
+# and tasks names) are encoded again and again.
+_ENCODED_IDS = dict()
+_ENCODED_IDS_MAX_SIZE = 8192
+
+
 def encode_id(entity_id):
     """Encode the id using only A-Za-z0-9_.
 
@@ -67,18 +108,25 @@ def encode_id(entity_id):
     return (unicode): encoded entity id.
 
     """
-    encoded_id = ""
-    for char in entity_id:
-        if char not in string.ascii_letters + string.digits:
-            encoded_id += "_%x" % ord(char)
-        else:
-            encoded_id += char
+    encoded_id = _ENCODED_IDS.get(entity_id)
+    if encoded_id is not None:
+        return encoded_id
+
+    encoded_id = entity_id.translate(_ENCODE_TABLE)
+
+    # The cache is large enough to hold the ids of any contest, so we
+    # don't bother evicting entries selectively.
+    if len(_ENCODED_IDS) >= _ENCODED_IDS_MAX_SIZE:
+        _ENCODED_IDS.clear()
+    _ENCODED_IDS[entity_id] = encoded_id
     return encoded_id
 
 
-def safe_put_data(ranking, resource, data, operation):
+def safe_put_data(session, ranking, resource, data, operation):
     """Send some data to ranking using a PUT request.
 
+    session (requests.Session): the session to send the request with;
+        reusing it allows to keep the connection to the ranking alive.
     ranking (bytes): the URL of ranking server.
     resource (bytes): the relative path of the entity.
     data (dict): the data to JSON-encode and send.
@@ -86,6 +134,8 @@ def safe_put_data(ranking, resource, data, operation):
         we're performing (to produce log messages).
 
     raise (CannotSendError): in case of communication errors.
+    raise (DataRejectedError): if the ranking refused the data as
+        invalid.
 
     """
     try:
@@ -93,14 +143,21 @@ def safe_put_data(ranking, resource, data, operation):
         # XXX With requests-1.2 auth is automatically extracted from
         # the URL: there is no need for this.
         auth = urlsplit(url)
-        res = requests.put(url, json.dumps(data),
-                           auth=(auth.username, auth.password),
-                           headers={'content-type': 'application/json'},
-                           verify=config.https_certfile)
+        # Payloads can be large (e.g., all the submissions of a contest
+        # after a restart): skip the whitespace JSON adds by default.
+        body = json.dumps(data, separators=(",", ":"))
+        res = session.put(url, body,
+                          auth=(auth.username, auth.password),
+                          headers={'content-type': 'application/json'},
+                          verify=config.https_certfile)
     except requests.exceptions.RequestException as error:
         msg = "%s while %s: %s." % (type(error).__name__, operation, error)
         logger.warning(msg)
         raise CannotSendError(msg)
+    if res.status_code in (400, 422):
+        msg = "Status %s while %s." % (res.status_code, operation)
+        logger.warning(msg)
+        raise DataRejectedError(msg)
     if 400 <= res.status_code < 600:
         msg = "Status %s while %s." % (res.status_code, operation)
         logger.warning(msg)
@@ -121,6 +178,23 @@ class ProxyOperation(QueueItem):
                 "data": self.data}
 
 
+def combine_operations(operations):
+    """Merge operations of the same type into a single operation.
+
+    operations ([ProxyOperation]): the operations to merge; in case of
+        data for the same entity, later operations take precedence.
+
+    return ([ProxyOperation]): one operation for each of the types of
+        the given operations.
+
+    """
+    data = dict()
+    for operation in operations:
+        data.setdefault(operation.type_, dict()).update(operation.data)
+    return [ProxyOperation(type_, type_data)
+            for type_, type_data in iteritems(data)]
+
+
 class ProxyExecutor(Executor):
     """A thread that sends data to one ranking.
 
@@ -158,9 +232,21 @@ class ProxyExecutor(Executor):
     # How many different entity types we know about.
     TYPE_COUNT = len(RESOURCE_PATHS)
 
+    # The entity types, grouped in the order in which they have to be
+    # sent: an entity can refer only to entities of a previous group
+    # (e.g., a task to its contest, a user to its team), hence types
+    # in the same group are independent and are sent concurrently.
+    TYPE_GROUPS = [
+        [CONTEST_TYPE, TEAM_TYPE],
+        [TASK_TYPE, USER_TYPE],
+        [SUBMISSION_TYPE],
+        [SUBCHANGE_TYPE]]
+
     # How long we wait after having failed to push data to a ranking
-    # before trying again.
+    # before trying again; the wait doubles at every consecutive
+    # failure, up to MAX_FAILURE_WAIT.
     FAILURE_WAIT = 60.0
+    MAX_FAILURE_WAIT = 300.0
 
     def __init__(self, ranking):
         """Create a proxy for the ranking at the given URL.
@@ -174,53 +260,165 @@ class ProxyExecutor(Executor):
 
         self._ranking = ranking
 
+        # A persistent session, so that the underlying connection is
+        # reused (through keep-alive) for all the requests we send to
+        # the ranking, instead of doing a new TCP (and possibly TLS)
+        # handshake every time.
+        self._session = requests.Session()
+
+        # The cumulative data that we will try to send to the ranking,
+        # built by combining items in the queue. What couldn't be sent
+        # is kept here and retried together with the following items.
+        # Entities are kept in insertion order, so that if the ranking
+        # is down for long we can drop the oldest ones.
+        self._data = list(OrderedDict() for i in range(self.TYPE_COUNT))
+
+        # The number of submissions and subchanges we gave up sending.
+        self._dropped = 0
+
+        # The number of consecutive failed attempts to send data.
+        self._failures = 0
+
     def execute(self, entries):
         """Consume (i.e. send) the data put in the queue, forever.
 
         Pick all operations found in the queue (if there aren't any,
-        block waiting until there are), combine them and send HTTP
-        requests to the target ranking. Do it until something very bad
-        happens (i.e. some exception is raised). If communication fails
-        don't stop, just wait FAILURE_WAIT seconds before restarting
-        the loop.
+        block waiting until there are), combine them with the data not
+        yet sent and send HTTP requests to the target ranking. If
+        communication fails don't stop, just wait before trying again:
+        FAILURE_WAIT seconds after the first failure, twice as much
+        after each of the following (up to MAX_FAILURE_WAIT). If new
+        operations arrived in the meantime, let them be fetched and
+        combined before retrying. Data refused by the ranking, and all
+        the data not yet sent in case of unexpected errors, is instead
+        dropped, as sending it again would fail again.
 
         Do all this cooperatively: yield at every blocking operation
-        (queue fetch, request send, failure wait, etc.). Since the
-        queue is joinable, also notify when the fetched jobs are done.
+        (queue fetch, request send, failure wait, etc.). Each ranking
+        has its own executor, running in its own greenlet, so a slow
+        or unreachable ranking doesn't delay the others.
 
         entries ([QueueEntry]): entries containing the operations to
             perform.
 
         """
-        # The cumulative data that we will try to send to the ranking,
-        # built by combining items in the queue.
-        data = list(dict() for i in range(self.TYPE_COUNT))
-
         for entry in entries:
-            data[entry.item.type_].update(entry.item.data)
+            self._data[entry.item.type_].update(entry.item.data)
+        self._drop_oldest()
+
+        while True:
+            try:
+                self._send_all()
+            except CannotSendError:
+                # A log message has already been produced.
+                pass
+            except Exception:
+                # Whoa! That's unexpected! The error would likely happen
+                # again, so we don't retry.
+                logger.error("Unexpected error, dropping the data not yet "
+                             "sent to ranking %s.", self._ranking,
+                             exc_info=True)
+                for data in self._data:
+                    data.clear()
+                self._failures = 0
+                return
+            else:
+                self._failures = 0
+                return
 
-        try:
-            for i in range(self.TYPE_COUNT):
-                # Send entities of type i.
-                if len(data[i]) > 0:
-                    # We abuse the resource path as the English
-                    # (plural) name for the entity type.
-                    name = self.RESOURCE_PATHS[i]
-                    operation = "sending %s to ranking %s" % (name,
-                                                              self._ranking)
-
-                    logger.debug(operation.capitalize())
-                    safe_put_data(
-                        self._ranking, "%s/" % name, data[i], operation)
-                    data[i].clear()
+            self._failures += 1
+            wait = min(self.FAILURE_WAIT * 2 ** (self._failures - 1),
+                       self.MAX_FAILURE_WAIT)
+            logger.info("Waiting %.0f seconds before trying again to send "
+                        "data to ranking %s.", wait, self._ranking)
+            gevent.sleep(wait)
+
+            if not self._operation_queue.empty():
+                return
+
+    def _drop_oldest(self):
+        """Bound the number of submissions and subchanges not yet sent.
+
+        If there are more than config.max_unsent_submissions_per_ranking
+        of them (which happens only if the ranking has been unreachable
+        for long) drop the oldest ones, as well as the subchanges of the
+        dropped submissions (the ranking would reject them). They'll be
+        sent again only when ProxyService is restarted.
+
+        """
+        max_unsent = config.max_unsent_submissions_per_ranking
+        submissions = self._data[self.SUBMISSION_TYPE]
+        subchanges = self._data[self.SUBCHANGE_TYPE]
+        if len(submissions) <= max_unsent and len(subchanges) <= max_unsent:
+            return
+
+        dropped_submissions = set()
+        while len(submissions) > max_unsent:
+            dropped_submissions.add(submissions.popitem(last=False)[0])
+        dropped = len(dropped_submissions)
+        for key, value in list(iteritems(subchanges)):
+            if value["submission"] in dropped_submissions:
+                del subchanges[key]
+                dropped += 1
+        while len(subchanges) > max_unsent:
+            subchanges.popitem(last=False)
+            dropped += 1
+
+        self._dropped += dropped
+        logger.warning("Too much data not yet sent to ranking %s, dropped "
+                       "the %d oldest submissions and subchanges (%d so "
+                       "far).", self._ranking, dropped, self._dropped)
+
+    def _send_all(self):
+        """Send all the data not yet sent to the ranking.
+
+        raise (CannotSendError): if some of the data could not be sent
+            and has to be sent again.
 
+        """
+        for group in self.TYPE_GROUPS:
+            # Send the entities of all types in the group, each in its
+            # own greenlet, to overlap the round trips.
+            jobs = [gevent.spawn(self._send, i, self._data[i])
+                    for i in group if len(self._data[i]) > 0]
+            gevent.joinall(jobs)
+            # Don't go on with the next groups if something wasn't
+            # sent, as their entities might depend on it.
+            if not all(job.get() for job in jobs):
+                raise CannotSendError("Failed to send %s." % ", ".join(
+                    self.RESOURCE_PATHS[i] for i in group))
+
+    def _send(self, type_, data):
+        """Send all the entities of one type to the ranking.
+
+        type_ (int): the type of the entities.
+        data (dict): the entities to send, indexed by their ids; it is
+            emptied if they are sent successfully or refused by the
+            ranking.
+
+        return (bool): False if the entities could not be sent and have
+            to be sent again, True otherwise.
+
+        """
+        # We abuse the resource path as the English (plural) name for
+        # the entity type.
+        name = self.RESOURCE_PATHS[type_]
+        operation = "sending %s to ranking %s" % (name, self._ranking)
+
+        logger.debug(operation.capitalize())
+        try:
+            safe_put_data(self._session, self._ranking, "%s/" % name,
+                          data, operation)
+        except DataRejectedError:
+            # The ranking refuses the whole request if any entity in it
+            # is invalid: retrying would block all the following data.
+            logger.error("Ranking %s refused the %s, dropped %d of them.",
+                         self._ranking, name, len(data))
         except CannotSendError:
             # A log message has already been produced.
-            gevent.sleep(self.FAILURE_WAIT)
-        except:
-            # Whoa! That's unexpected!
-            logger.error("Unexpected error.", exc_info=True)
-            gevent.sleep(self.FAILURE_WAIT)
+            return False
+        data.clear()
+        return True
 
 
 class ProxyService(TriggeredService):
@@ -240,6 +438,10 @@ class ProxyService(TriggeredService):
 
     """
 
+    # The maximum number of submissions that _missing_operations loads
+    # with a single query, by listing their ids.
+    MISSING_OPERATIONS_CHUNK_SIZE = 1000
+
     def __init__(self, shard, contest_id):
         """Start the service with the given parameters.
 
@@ -263,6 +465,13 @@ class ProxyService(TriggeredService):
         self.scores_sent_to_rankings = set()
         self.tokens_sent_to_rankings = set()
 
+        # The encoded ids of the users (indexed by participation id)
+        # and of the tasks (indexed by task id) of the contest, filled
+        # at every (re)initialization, as they're needed for each
+        # submission we send.
+        self.encoded_usernames = dict()
+        self.encoded_task_names = dict()
+
         # Create one executor for each ranking.
         self.rankings = list()
         for ranking in config.rankings:
@@ -280,11 +489,60 @@ class ProxyService(TriggeredService):
         """Return a generator of data to be sent to the rankings..
 
         """
-        counter = 0
+        operations = list()
         with SessionGen() as session:
-            submissions = get_submissions(session, contest_id=self.contest_id) \
+            # Only consider the submissions that have something to
+            # send, that is, a scored result on the active dataset or a
+            # token (the result must exist anyway, see below).
+            query = get_submissions(session, contest_id=self.contest_id) \
                 .filter(not_(Participation.hidden)) \
-                .filter(Submission.official).all()
+                .filter(Submission.official) \
+                .join(SubmissionResult,
+                      (SubmissionResult.submission_id == Submission.id)
+                      & (SubmissionResult.dataset_id
+                         == Task.active_dataset_id)) \
+                .outerjoin(Submission.token) \
+                .filter(SubmissionResult.filter_scored()
+                        | Token.id.isnot(None))
+
+            # Most of them have usually been sent already: find out,
+            # fetching just some columns, which ones haven't been...
+            candidates = query.with_entities(
+                Submission.id, SubmissionResult.filter_scored(),
+                Token.id.isnot(None)).all()
+            submission_ids = sorted(
+                submission_id for submission_id, scored, tokened
+                in candidates
+                if (scored and
+                    submission_id not in self.scores_sent_to_rankings)
+                or (tokened and
+                    submission_id not in self.tokens_sent_to_rankings))
+            if len(submission_ids) == 0:
+                return 0
+
+            # ... and load only those, with all we need to send them. If
+            # they are most of them (e.g., after a restart) we rather
+            # load all the candidates, and skip the others below, than
+            # make the database parse a huge IN clause (twice, as the
+            # subquery loading the results repeats it). Otherwise we
+            # load them in chunks of bounded size.
+            # The tasks and the participations (joined by
+            # get_submissions) and the tokens (joined above) are already
+            # in the query: fill them from those joins.
+            query = query \
+                .options(contains_eager(Submission.task)) \
+                .options(contains_eager(Submission.participation)
+                         .joinedload(Participation.user)) \
+                .options(contains_eager(Submission.token)) \
+                .options(subqueryload(Submission.results))
+            if 2 * len(submission_ids) > len(candidates):
+                submissions = query.all()
+            else:
+                chunk_size = ProxyService.MISSING_OPERATIONS_CHUNK_SIZE
+                submissions = list()
+                for i in range(0, len(submission_ids), chunk_size):
+                    submissions.extend(query.filter(Submission.id.in_(
+                        submission_ids[i:i + chunk_size])).all())
 
             for submission in submissions:
                 # The submission result can be None if the dataset has
@@ -295,17 +553,19 @@ class ProxyService(TriggeredService):
 
                 if sr.scored() and \
                         submission.id not in self.scores_sent_to_rankings:
-                    for operation in self.operations_for_score(submission):
-                        self.enqueue(operation)
-                        counter += 1
+                    operations.extend(
+                        self.operations_for_score(submission, sr))
 
                 if submission.tokened() and \
                         submission.id not in self.tokens_sent_to_rankings:
-                    for operation in self.operations_for_token(submission):
-                        self.enqueue(operation)
-                        counter += 1
+                    operations.extend(self.operations_for_token(submission))
+
+        # Merge the operations here, once, instead of letting each
+        # proxy queue (one per ranking) store and merge them all.
+        for operation in combine_operations(operations):
+            self.enqueue(operation)
 
-        return counter
+        return len(operations)
 
     def initialize(self):
         """Send basic data to all the rankings.
@@ -319,85 +579,154 @@ class ProxyService(TriggeredService):
         """
         logger.info("Initializing rankings.")
 
+        # Only copy the fields we need here, while the session is
+        # open; the data to send is prepared after it has been closed.
         with SessionGen() as session:
-            contest = Contest.get_from_id(self.contest_id, session)
+            contest = session.query(Contest) \
+                .options(subqueryload(Contest.participations)
+                         .joinedload(Participation.user)) \
+                .options(subqueryload(Contest.participations)
+                         .joinedload(Participation.team)) \
+                .options(subqueryload(Contest.tasks)
+                         .joinedload(Task.active_dataset)
+                         .subqueryload(Dataset.testcases)) \
+                .filter(Contest.id == self.contest_id).first()
 
             if contest is None:
                 logger.error("Received request for unexistent contest "
                              "id %s.", self.contest_id)
                 raise KeyError("Contest not found.")
 
-            contest_id = encode_id(contest.name)
+            contest_name = contest.name
             contest_data = {
                 "name": contest.description,
                 "begin": int(make_timestamp(contest.start)),
                 "end": int(make_timestamp(contest.stop)),
                 "score_precision": contest.score_precision}
 
-            users = dict()
-            teams = dict()
-
-            for participation in contest.participations:
-                user = participation.user
-                team = participation.team
-                if not participation.hidden:
-                    users[encode_id(user.username)] = {
-                        "f_name": user.first_name,
-                        "l_name": user.last_name,
-                        "team": team.code if team is not None else None,
-                    }
-                    if team is not None:
-                        teams[encode_id(team.code)] = {
-                            "name": team.name
-                        }
-
-            tasks = dict()
+            participations = [
+                (p.id, p.user.username, p.user.first_name, p.user.last_name,
+                 p.team.code if p.team is not None else None,
+                 p.team.name if p.team is not None else None)
+                for p in contest.participations if not p.hidden]
 
+            task_rows = list()
             for task in contest.tasks:
                 score_type = task.active_dataset.score_type_object
-                tasks[encode_id(task.name)] = {
-                    "short_name": task.name,
-                    "name": task.title,
-                    "contest": encode_id(contest.name),
-                    "order": task.num,
-                    "max_score": score_type.max_score,
-                    "extra_headers": score_type.ranking_headers,
-                    "score_precision": task.score_precision,
-                    "score_mode": task.score_mode,
+                task_rows.append((
+                    task.id, task.name, task.title, task.num,
+                    score_type.max_score, score_type.ranking_headers,
+                    task.score_precision, task.score_mode))
+
+        contest_id = encode_id(contest_name)
+
+        users = dict()
+        teams = dict()
+        encoded_usernames = dict()
+
+        for participation_id, username, first_name, last_name, team_code, \
+                team_name in participations:
+            encoded_usernames[participation_id] = encode_id(username)
+            users[encoded_usernames[participation_id]] = {
+                "f_name": first_name,
+                "l_name": last_name,
+                "team": team_code,
+            }
+            if team_code is not None:
+                teams[encode_id(team_code)] = {
+                    "name": team_name
                 }
 
+        tasks = dict()
+        encoded_task_names = dict()
+
+        for task_id, name, title, num, max_score, ranking_headers, \
+                score_precision, score_mode in task_rows:
+            encoded_task_names[task_id] = encode_id(name)
+            tasks[encoded_task_names[task_id]] = {
+                "short_name": name,
+                "name": title,
+                "contest": contest_id,
+                "order": num,
+                "max_score": max_score,
+                "extra_headers": ranking_headers,
+                "score_precision": score_precision,
+                "score_mode": score_mode,
+            }
+
+        self.encoded_usernames = encoded_usernames
+        self.encoded_task_names = encoded_task_names
+
         self.enqueue(ProxyOperation(ProxyExecutor.CONTEST_TYPE,
                                     {contest_id: contest_data}))
         self.enqueue(ProxyOperation(ProxyExecutor.TEAM_TYPE, teams))
         self.enqueue(ProxyOperation(ProxyExecutor.USER_TYPE, users))
         self.enqueue(ProxyOperation(ProxyExecutor.TASK_TYPE, tasks))
 
-    def operations_for_score(self, submission):
+    def _encoded_username(self, submission):
+        """Return the encoded id of the user of a submission.
+
+        submission (Submission): the submission.
+
+        return (unicode): the id of the user, as sent to rankings.
+
+        """
+        encoded_username = \
+            self.encoded_usernames.get(submission.participation_id)
+        if encoded_username is None:
+            # The participation was added after the last initialization.
+            encoded_username = \
+                encode_id(submission.participation.user.username)
+        return encoded_username
+
+    def _encoded_task_name(self, submission):
+        """Return the encoded id of the task of a submission.
+
+        submission (Submission): the submission.
+
+        return (unicode): the id of the task, as sent to rankings.
+
+        """
+        encoded_task_name = self.encoded_task_names.get(submission.task_id)
+        if encoded_task_name is None:
+            # The task was added after the last initialization.
+            encoded_task_name = encode_id(submission.task.name)
+        return encoded_task_name
+
+    def operations_for_score(self, submission, submission_result=None):
         """Send the score for the given submission to all rankings.
 
         Put the submission and its score subchange in all the proxy
         queues for them to be sent to rankings.
 
+        submission (Submission): the submission.
+        submission_result (SubmissionResult|None): its result on the
+            active dataset, if the caller already fetched it.
+
         """
-        submission_result = submission.get_result()
+        if submission_result is None:
+            submission_result = submission.get_result()
 
         # Data to send to remote rankings.
         submission_id = "%d" % submission.id
+        timestamp = int(make_timestamp(submission.timestamp))
         submission_data = {
-            "user": encode_id(submission.participation.user.username),
-            "task": encode_id(submission.task.name),
-            "time": int(make_timestamp(submission.timestamp))}
+            "user": self._encoded_username(submission),
+            "task": self._encoded_task_name(submission),
+            "time": timestamp}
 
-        subchange_id = "%d%ss" % (make_timestamp(submission.timestamp),
-                                  submission_id)
+        subchange_id = "%d%ss" % (timestamp, submission_id)
         subchange_data = {
             "submission": submission_id,
-            "time": int(make_timestamp(submission.timestamp))}
+            "time": timestamp}
 
         # This check is probably useless.
         if submission_result is not None and submission_result.scored():
             # We're sending the unrounded score to RWS
             subchange_data["score"] = submission_result.score
+            # The ranking details are stored already in the format RWS
+            # expects (a list of strings), so they're forwarded as they
+            # are, without any (de)serialization.
             subchange_data["extra"] = submission_result.ranking_score_details
 
         self.scores_sent_to_rankings.add(submission.id)
@@ -418,15 +747,15 @@ class ProxyService(TriggeredService):
         # Data to send to remote rankings.
         submission_id = "%d" % submission.id
         submission_data = {
-            "user": encode_id(submission.participation.user.username),
-            "task": encode_id(submission.task.name),
+            "user": self._encoded_username(submission),
+            "task": self._encoded_task_name(submission),
             "time": int(make_timestamp(submission.timestamp))}
 
-        subchange_id = "%d%st" % (make_timestamp(submission.token.timestamp),
-                                  submission_id)
+        token_timestamp = int(make_timestamp(submission.token.timestamp))
+        subchange_id = "%d%st" % (token_timestamp, submission_id)
         subchange_data = {
             "submission": submission_id,
-            "time": int(make_timestamp(submission.token.timestamp)),
+            "time": token_timestamp,
             "token": True}
 
         self.tokens_sent_to_rankings.add(submission.id)
@@ -544,11 +873,21 @@ class ProxyService(TriggeredService):
             # max_score and/or extra_headers might have changed.
             self.reinitialize()
 
-            for submission in task.submissions:
-                # Update RWS.
-                if not submission.participation.hidden and \
-                        submission.official and \
-                        submission.get_result() is not None and \
-                        submission.get_result().scored():
-                    for operation in self.operations_for_score(submission):
-                        self.enqueue(operation)
+            submissions = get_submissions(session, task_id=task.id) \
+                .options(joinedload(Submission.participation)
+                         .joinedload(Participation.user)) \
+                .options(subqueryload(Submission.results)).all()
+
+            operations = list()
+            for submission in submissions:
+                if submission.participation.hidden or \
+                        not submission.official:
+                    continue
+                sr = submission.get_result(dataset)
+                if sr is not None and sr.scored():
+                    operations.extend(
+                        self.operations_for_score(submission, sr))
+
+        # Update RWS, sending the new scores of the whole task together.
+        for operation in combine_operations(operations):
+            self.enqueue(operation)
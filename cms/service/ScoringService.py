@@ -35,9 +35,12 @@ from future.builtins import *  # noqa
 
 import logging
 
+from sqlalchemy.orm import joinedload, subqueryload
+
 from cms import ServiceCoord, config
 from cms.io import Executor, TriggeredService, rpc_method
-from cms.db import SessionGen, Submission, Dataset, get_submission_results
+from cms.db import SessionGen, Submission, Dataset, SubmissionResult, \
+    get_submission_results
 
 from cmscommon.datetime import make_datetime
 
@@ -48,23 +51,93 @@ logger = logging.getLogger(__name__)
 
 
 class ScoringExecutor(Executor):
+
+    # Maximum number of submission results scored (and committed) in
+    # the same transaction.
+    MAX_OPERATIONS_PER_BATCH = 16
+
     def __init__(self, proxy_service):
-        super(ScoringExecutor, self).__init__()
+        super(ScoringExecutor, self).__init__(batch_executions=True)
         self.proxy_service = proxy_service
 
-    def execute(self, entry):
-        """Assign a score to a submission result.
+    def max_operations_per_batch(self):
+        """Return the maximum number of operations per batch.
+
+        """
+        return ScoringExecutor.MAX_OPERATIONS_PER_BATCH
+
+    def execute(self, entries):
+        """Assign a score to a batch of submission results.
+
+        This is the core of ScoringService: here we retrieve the
+        results from the database, check if they are in the correct
+        status, instantiate their ScoreType, compute their score, store
+        them back in the database (all in a single transaction) and
+        tell ProxyService to update RWS if needed.
 
-        This is the core of ScoringService: here we retrieve the result
-        from the database, check if it is in the correct status,
-        instantiate its ScoreType, compute its score, store it back in
-        the database and tell ProxyService to update RWS if needed.
+        An error on one of the operations is logged and doesn't prevent
+        the others from being performed: each of them is done in its
+        own savepoint, rolled back in case of errors, so that also
+        database errors don't abort the whole transaction.
 
-        entry (QueueEntry): entry containing the operation to perform.
+        entries ([QueueEntry]): entries containing the operations to
+            perform.
 
         """
-        operation = entry.item
+        # The submissions whose score has to be sent to RWS, with
+        # their timestamp.
+        to_notify = list()
+
         with SessionGen() as session:
+            for entry in entries:
+                operation = entry.item
+                try:
+                    with session.begin_nested():
+                        submission = self._score(operation, session)
+                except Exception:
+                    logger.error("Unexpected error when scoring submission "
+                                 "result %d(%d).", operation.submission_id,
+                                 operation.dataset_id, exc_info=True)
+                    continue
+                if submission is not None:
+                    to_notify.append((submission.id, submission.timestamp))
+
+            # Store them.
+            session.commit()
+
+        for submission_id, timestamp in to_notify:
+            logger.info(
+                "Submission scored %.1f seconds after submission",
+                (make_datetime() - timestamp).total_seconds())
+            self.proxy_service.submission_scored(
+                submission_id=submission_id)
+
+    def _score(self, operation, session):
+        """Assign a score to a submission result, without committing.
+
+        operation (ScoringOperation): the operation to perform.
+        session (Session): the database session to use.
+
+        return (Submission|None): the submission, if the dataset is the
+            active one (and thus RWS has to be updated), None
+            otherwise.
+
+        raise (ValueError): if the submission result cannot be scored.
+
+        """
+        # Obtain submission result, together with what we need to
+        # score it: its evaluations, its submission and its dataset.
+        submission_result = session.query(SubmissionResult)\
+            .filter(SubmissionResult.submission_id ==
+                    operation.submission_id)\
+            .filter(SubmissionResult.dataset_id == operation.dataset_id)\
+            .options(joinedload(SubmissionResult.submission)
+                     .joinedload(Submission.task))\
+            .options(joinedload(SubmissionResult.dataset))\
+            .options(subqueryload(SubmissionResult.evaluations))\
+            .first()
+
+        if submission_result is None:
             # Obtain submission.
             submission = Submission.get_from_id(operation.submission_id,
                                                 session)
@@ -78,48 +151,41 @@ class ScoringExecutor(Executor):
                 raise ValueError("Dataset %d not found in the database." %
                                  operation.dataset_id)
 
-            # Obtain submission result.
-            submission_result = submission.get_result(dataset)
-
             # It means it was not even compiled (for some reason).
-            if submission_result is None:
-                raise ValueError("Submission result %d(%d) was not found." %
+            raise ValueError("Submission result %d(%d) was not found." %
+                             (operation.submission_id,
+                              operation.dataset_id))
+
+        submission = submission_result.submission
+        dataset = submission_result.dataset
+
+        # Check if it's ready to be scored.
+        if not submission_result.needs_scoring():
+            if submission_result.scored():
+                logger.info("Submission result %d(%d) is already scored.",
+                            operation.submission_id, operation.dataset_id)
+                return None
+            else:
+                raise ValueError("The state of the submission result "
+                                 "%d(%d) doesn't allow scoring." %
                                  (operation.submission_id,
                                   operation.dataset_id))
 
-            # Check if it's ready to be scored.
-            if not submission_result.needs_scoring():
-                if submission_result.scored():
-                    logger.info("Submission result %d(%d) is already scored.",
-                                operation.submission_id, operation.dataset_id)
-                    return
-                else:
-                    raise ValueError("The state of the submission result "
-                                     "%d(%d) doesn't allow scoring." %
-                                     (operation.submission_id,
-                                      operation.dataset_id))
-
-            # Instantiate the score type.
-            score_type = dataset.score_type_object
-
-            # Compute score and fill it in the database.
-            submission_result.score, \
-                submission_result.score_details, \
-                submission_result.public_score, \
-                submission_result.public_score_details, \
-                submission_result.ranking_score_details = \
-                score_type.compute_score(submission_result)
-
-            # Store it.
-            session.commit()
-
-            # If dataset is the active one, update RWS.
-            if dataset is submission.task.active_dataset:
-                logger.info(
-                    "Submission scored %.1f seconds after submission",
-                    (make_datetime() - submission.timestamp).total_seconds())
-                self.proxy_service.submission_scored(
-                    submission_id=submission.id)
+        # Instantiate the score type.
+        score_type = dataset.score_type_object
+
+        # Compute score and fill it in the database.
+        submission_result.score, \
+            submission_result.score_details, \
+            submission_result.public_score, \
+            submission_result.public_score_details, \
+            submission_result.ranking_score_details = \
+            score_type.compute_score(submission_result)
+
+        # If dataset is the active one, update RWS.
+        if dataset is submission.task.active_dataset:
+            return submission
+        return None
 
 
 class ScoringService(TriggeredService):
@@ -26,6 +26,8 @@ from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
+import errno
+import hashlib
 import io
 import json
 import logging
@@ -33,8 +35,23 @@ import os
 import re
 import subprocess
 
+from collections import defaultdict
 from datetime import timedelta
 
+import gevent.pool
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
 from cms.db import Task, Dataset, Manager, Testcase, Attachment, Statement
 
 from .base_loader import TaskLoader
@@ -43,10 +60,157 @@ from .base_loader import TaskLoader
 logger = logging.getLogger(__name__)
 
 
+# The parsed content of the JSON files read by the loader, indexed by
+# path, together with the modification time and size of the files when
+# they were read. Useful when the same task is loaded more than once.
+_JSON_CACHE = {}
+
+# Marker for missing values in dictionaries (where None is a value).
+_MISSING = object()
+
+# The output of "--version" of the compilers used, indexed by their
+# names.
+_COMPILER_VERSIONS = {}
+
+
 def make_timedelta(t):
     return timedelta(seconds=t)
 
 
+def _copy_values(src, dst, keys):
+    """Copy the values of some keys, if present, from src to dst.
+
+    src (dict): the dictionary to copy values from.
+    dst (dict): the dictionary to copy values to.
+    keys ([unicode]): the keys to copy.
+
+    """
+    for key in keys:
+        value = src.get(key, _MISSING)
+        if value is not _MISSING:
+            dst[key] = value
+
+
+def _list_directory(path):
+    """Return the entries of a directory, or None if it does not exist.
+
+    path (str): the path of the directory.
+
+    return ([DirEntry]|None): the entries of the directory.
+
+    """
+    try:
+        return list(scandir(path))
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _load_json(path):
+    """Return the parsed content of a JSON file, using the cache.
+
+    The returned object is shared with other callers and must not be
+    modified.
+
+    path (str): the path of the JSON file.
+
+    return (object): the parsed content of the file.
+
+    """
+    stat = os.stat(path)
+    file_id = (stat.st_mtime, stat.st_size)
+    cached = _JSON_CACHE.get(path)
+    if cached is None or cached[0] != file_id:
+        # Read the whole (small) file at once, and decode and parse it
+        # in a single call each, instead of going through a text
+        # stream.
+        with io.open(path, 'rb') as json_file:
+            cached = (file_id, json.loads(json_file.read().decode('utf-8')))
+        _JSON_CACHE[path] = cached
+    return cached[1]
+
+
+def _compiler_version(compiler):
+    """Return the version information of a compiler.
+
+    compiler (unicode): the name of the compiler.
+
+    return (bytes): the output of the compiler's --version.
+
+    """
+    version = _COMPILER_VERSIONS.get(compiler)
+    if version is None:
+        version = subprocess.check_output([compiler, "--version"])
+        _COMPILER_VERSIONS[compiler] = version
+    return version
+
+
+class _Compilation(object):
+    """The compilation, in the background, of a program of a task.
+
+    As compiling is slow, it is skipped if the executable was already
+    compiled (by a previous load) from the same source, with the same
+    command and compiler: to know that, a hash of them is stored,
+    after each successful compilation, in a stamp file next to the
+    executable. As the source can include the other files in its
+    folder (e.g., checkers include testlib.h), they are hashed too.
+    Otherwise the command is run through ccache, when available.
+
+    """
+
+    def __init__(self, source, executable, command):
+        """Start compiling, unless the executable is up to date.
+
+        source (str): the path of the source file.
+        executable (str): the path of the executable to produce.
+        command ([unicode]): the compilation command, without the
+            source and executable paths.
+
+        """
+        self._process = None
+        self._executable = executable
+        self._stamp = executable + ".stamp"
+
+        command = command + ["-o", executable, source]
+        hasher = hashlib.sha1("\0".join(command).encode('utf-8'))
+        hasher.update(_compiler_version(command[0]))
+        outputs = {os.path.basename(executable),
+                   os.path.basename(self._stamp)}
+        for entry in sorted(scandir(os.path.dirname(source)),
+                            key=lambda entry: entry.name):
+            if entry.name not in outputs and entry.is_file():
+                with io.open(entry.path, 'rb') as source_file:
+                    file_digest = hashlib.sha1(source_file.read())
+                hasher.update(("\0%s\0%s" % (
+                    entry.name, file_digest.hexdigest())).encode('utf-8'))
+        self._fingerprint = hasher.hexdigest()
+
+        if os.path.exists(self._stamp):
+            with io.open(self._stamp, 'rb') as stamp:
+                up_to_date = \
+                    stamp.read().decode('ascii') == self._fingerprint
+            if up_to_date and os.path.exists(executable):
+                logger.info("%s is up to date, not compiling",
+                            os.path.basename(executable))
+                return
+            os.remove(self._stamp)
+
+        if which("ccache") is not None:
+            command = ["ccache"] + command
+        self._process = subprocess.Popen(command)
+
+    def wait(self):
+        """Wait for the compilation to end, if still running.
+
+        """
+        if self._process is not None:
+            if self._process.wait() == 0:
+                with io.open(self._stamp, 'wb') as stamp:
+                    stamp.write(self._fingerprint.encode('ascii'))
+            self._process = None
+
+
 class TpsTaskLoader(TaskLoader):
     """Loader for TPS exported tasks.
     """
@@ -54,6 +218,10 @@ class TpsTaskLoader(TaskLoader):
     short_name = 'tps_task'
     description = 'TPS task format'
 
+    # Maximum number of files stored in the file cacher at the same
+    # time.
+    MAX_CONCURRENT_UPLOADS = 8
+
     @staticmethod
     def detect(path):
         """See docstring in class Loader.
@@ -112,6 +280,20 @@ class TpsTaskLoader(TaskLoader):
 
         return []
 
+    def _put_files_from_paths(self, files):
+        """Store some files in the file cacher, concurrently.
+
+        files ([(unicode, unicode)]): pairs of paths and descriptions
+            of the files to store.
+
+        return ([unicode]): the digests of the files, in the same order.
+
+        """
+        pool = gevent.pool.Pool(TpsTaskLoader.MAX_CONCURRENT_UPLOADS)
+        return pool.map(
+            lambda path_desc: self.file_cacher.put_file_from_path(*path_desc),
+            files)
+
     def get_task(self, get_statement=True):
         """See docstring in class Loader.
         """
@@ -120,8 +302,7 @@ class TpsTaskLoader(TaskLoader):
         if not os.path.exists(json_src):
             logger.critical('No task found.')
             raise IOError('No task found at path %s' % json_src)
-        with io.open(json_src, 'rt', encoding='utf-8') as json_file:
-            data = json.load(json_file)
+        data = _load_json(json_src)
 
         name = data['code']
         logger.info("Loading parameters for task %s.", name)
@@ -137,27 +318,28 @@ class TpsTaskLoader(TaskLoader):
         # Statements
         if get_statement:
             statements_dir = os.path.join(self.path, 'statement')
-            if os.path.exists(statements_dir):
+            statements_entries = _list_directory(statements_dir)
+            if statements_entries is not None:
                 statements = [
-                    filename
-                    for filename in os.listdir(statements_dir)
-                    if filename[-4:] == ".pdf"]
+                    entry
+                    for entry in statements_entries
+                    if entry.name.endswith(".pdf") and entry.is_file()]
                 if len(statements) > 0:
-                    args['statements'] = dict()
+                    args['statements'] = {}
                     logger.info('Statements found')
-                for statement in statements:
-                    language = statement[:-4]
+                languages = [statement.name[:-4] for statement in statements]
+                digests = self._put_files_from_paths([
+                    (statement.path,
+                     "Statement for task %s (lang: %s)" % (name, language))
+                    for statement, language in zip(statements, languages)])
+                for language, digest in zip(languages, digests):
                     if language == "en_US":
                         args["primary_statements"] = ["en_US"]
-                    digest = self.file_cacher.put_file_from_path(
-                        os.path.join(statements_dir, statement),
-                        "Statement for task %s (lang: %s)" %
-                        (name, language))
                     args['statements'][language] = Statement(language, digest)
 
         # Attachments
         if get_statement:
-            args["attachments"] = dict()
+            args["attachments"] = {}
             attachments_path = os.path.join(self.path, name + '.zip')
             if os.path.exists(attachments_path):
                 logger.info("Attachments found")
@@ -175,32 +357,44 @@ class TpsTaskLoader(TaskLoader):
                     args["attachments"][filename] = Attachment(filename, digest)
                 '''
 
-        data["type"] = \
-            data["type"][0].upper() + data["type"][1:]
+        task_type = data["type"][0].upper() + data["type"][1:]
+
+        ignore_datasets = data.get('ignore_datasets', False)
 
         # Setting the submission format
         # Obtaining testcases' codename
+        # (and the paths of their input files, and the codenames of
+        # those having an output file, so we won't need to look for
+        # them again)
         testcases_dir = os.path.join(self.path, 'tests')
-        if not os.path.exists(testcases_dir):
-            logger.warning('Testcase folder was not found')
-            testcase_codenames = []
+        testcase_inputs = []
+        testcase_outputs = set()
+        if ignore_datasets and task_type != 'OutputOnly':
+            # Testcases are needed only for the dataset and for the
+            # submission format of OutputOnly tasks.
+            testcases_entries = []
         else:
-            testcase_codenames = sorted([
-                filename[:-3]
-                for filename in os.listdir(testcases_dir)
-                if filename[-3:] == '.in'])
-        if data["type"] == 'OutputOnly':
-            args["submission_format"] = list()
-            for codename in testcase_codenames:
-                args["submission_format"].append("output_%s.txt" % codename)
-        elif data["type"] == 'Notice':
-            args["submission_format"] = list()
+            testcases_entries = _list_directory(testcases_dir)
+            if testcases_entries is None:
+                logger.warning('Testcase folder was not found')
+                testcases_entries = []
+        for entry in testcases_entries:
+            if entry.name.endswith('.in') and entry.is_file():
+                testcase_inputs.append((entry.name[:-3], entry.path))
+            elif entry.name.endswith('.out') and entry.is_file():
+                testcase_outputs.add(entry.name[:-4])
+        testcase_inputs.sort()
+        testcase_codenames = [codename for codename, _ in testcase_inputs]
+        if task_type == 'OutputOnly':
+            args["submission_format"] = [
+                "output_%s.txt" % codename for codename in testcase_codenames]
+        elif task_type == 'Notice':
+            args["submission_format"] = []
         else:
             args["submission_format"] = ["%s.%%l" % name]
 
         # Task information
-        if 'feedback_level' in data:
-            args['feedback_level'] = data['feedback_level']
+        _copy_values(data, args, ['feedback_level'])
 
         # Tokens parameters
         # args['max_user_test_number'] = 10
@@ -215,70 +409,64 @@ class TpsTaskLoader(TaskLoader):
         # args['token_gen_max'] = 2
 
         # Limits
-        if 'max_submission_number' in data:
-            args['max_submission_number'] = data['max_submission_number']
-        if 'max_user_test_number' in data:
-            args['max_user_test_number'] = data['max_user_test_number']
-        if 'min_submission_interval' in data:
-            if data['min_submission_interval'] is None:
-                args['min_submission_interval'] = None
-            else:
-                args['min_submission_interval'] = make_timedelta(data['min_submission_interval'])
-        if 'min_user_test_interval' in data:
-            if data['min_user_test_interval'] is None:
-                args['min_user_test_interval'] = None
-            else:
-                args['min_user_test_interval'] = make_timedelta(data['min_user_test_interval'])
+        _copy_values(data, args,
+                     ['max_submission_number', 'max_user_test_number'])
+        for key in ['min_submission_interval', 'min_user_test_interval']:
+            interval = data.get(key, _MISSING)
+            if interval is not _MISSING:
+                args[key] = None if interval is None \
+                    else make_timedelta(interval)
 
         # Score options
-        if 'score_precision' in data:
-            args['score_precision'] = int(data['score_precision'])
-        if 'score_mode' in data:
-            args['score_mode'] = data['score_mode']
+        score_precision = data.get('score_precision', _MISSING)
+        if score_precision is not _MISSING:
+            args['score_precision'] = int(score_precision)
+        _copy_values(data, args, ['score_mode'])
 
         task = Task(**args)
 
-        ignore_datasets = data['ignore_datasets'] if 'ignore_datasets' in data else False
-
         if ignore_datasets:
             logger.info("Task parameters loaded.")
             logger.info("Dataset loading skipped.")
 
             return task
 
-        args = dict()
+        args = {}
 
         args["task"] = task
         args["description"] = "Default"
         args["autojudge"] = True
 
-        if data['type'] != 'OutputOnly' \
-                and data['type'] != 'Notice':
+        if task_type != 'OutputOnly' \
+                and task_type != 'Notice':
             args["time_limit"] = float(data['time_limit'])
             args["memory_limit"] = int(data['memory_limit'])
 
         args["managers"] = {}
 
+        # The checker and the manager are compiled in the background,
+        # while the other files are stored; we wait for the compilers
+        # only when we need the executables.
+        compilations = []
+
         # Checker
         checker_dir = os.path.join(self.path, "checker")
         checker_src = os.path.join(checker_dir, "checker.cpp")
+        checker_exe = os.path.join(checker_dir, "checker")
+        checker_compilation = None
 
-        ignore_checker = data['ignore_checker'] if 'ignore_checker' in data else False
+        ignore_checker = data.get('ignore_checker', False)
 
         if ignore_checker:
             logger.info("Checker is ignored, using diff if necessary")
             evaluation_param = "diff"
         elif os.path.exists(checker_src):
             logger.info("Checker found, compiling")
-            checker_exe = os.path.join(checker_dir, "checker")
-            subprocess.call([
-                "g++", "-x", "c++", "-std=gnu++14", "-O2", "-static", "-DCMS",
-                "-o", checker_exe, checker_src
+            checker_compilation = _Compilation(checker_src, checker_exe, [
+                "g++", "-pipe", "-x", "c++", "-std=gnu++14", "-O2", "-static",
+                "-DCMS"
             ])
-            digest = self.file_cacher.put_file_from_path(
-                checker_exe,
-                "Manager for task %s" % name)
-            args["managers"]['checker'] = Manager("checker", digest)
+            compilations.append(checker_compilation)
             evaluation_param = "comparator"
         else:
             logger.info("Checker not found, using diff if necessary")
@@ -286,15 +474,15 @@ class TpsTaskLoader(TaskLoader):
 
         # Note that the original TPS worked with custom task type Batch2017
         # and Communication2017 instead of Batch and Communication.
-        args["task_type"] = data['type']
+        args["task_type"] = task_type
         args["task_type_parameters"] = \
             self._get_task_type_parameters(
-                data, data['type'], evaluation_param)
+                data, task_type, evaluation_param)
 
         # Graders
         graders_dir = os.path.join(self.path, 'grader')
 
-        if data['type'] == 'TwoSteps':
+        if task_type == 'TwoSteps':
             pas_manager = name + 'lib.pas'
             pas_manager_path = os.path.join(graders_dir, pas_manager)
             if not os.path.exists(pas_manager_path):
@@ -302,70 +490,100 @@ class TpsTaskLoader(TaskLoader):
                     ''.encode('utf-8'), 'Pascal manager for task %s' % name)
                 args["managers"][pas_manager] = Manager(pas_manager, digest)
 
-        def get_file_list(files_dir, prefix, except_files):
+        def get_file_list(entries, prefix, except_files):
             rt = []
-            for filename in os.listdir(files_dir):
-                if not filename in except_files:
-                    if os.path.isdir(os.path.join(files_dir, filename)):
-                        rt += get_file_list(os.path.join(files_dir, filename), os.path.join(prefix, filename), except_files)
+            for entry in entries:
+                if entry.name not in except_files:
+                    relative_path = os.path.join(prefix, entry.name)
+                    if entry.is_dir():
+                        rt += get_file_list(scandir(entry.path),
+                                            relative_path, except_files)
                     else:
-                        rt.append(os.path.join(prefix, filename))
+                        rt.append(relative_path)
             return rt
 
-        if not os.path.exists(graders_dir):
+        graders_entries = _list_directory(graders_dir)
+        if graders_entries is None:
             logger.warning('Grader folder was not found')
             graders_list = []
         else:
-            graders_list = get_file_list(graders_dir, '', {'manager.cpp'})
-        for grader_name in graders_list:
-            grader_src = os.path.join(graders_dir, grader_name)
-            digest = self.file_cacher.put_file_from_path(
-                grader_src,
-                "Manager for task %s" % name)
-            grader_name = os.path.basename(grader_name)
-            if data['type'] == 'Communication' \
-                    and os.path.splitext(grader_name)[0] == 'grader':
-                grader_name = 'stub' + os.path.splitext(grader_name)[1]
-            args["managers"][grader_name] = Manager(grader_name, digest)
+            graders_list = get_file_list(graders_entries, '',
+                                         {'manager.cpp', 'manager.stamp'})
 
-        # Manager
+        # Manager (compiled only after listing the graders, as the
+        # executable is written in the same directory).
         manager_src = os.path.join(graders_dir, 'manager.cpp')
+        manager_exe = os.path.join(graders_dir, "manager")
+        manager_compilation = None
 
         if os.path.exists(manager_src):
             logger.info("Manager found, compiling")
-            manager_exe = os.path.join(graders_dir, "manager")
-            subprocess.call([
-                "g++", "-x", "c++", "-O2", "-static",
-                "-o", manager_exe, manager_src
+            manager_compilation = _Compilation(manager_src, manager_exe, [
+                "g++", "-pipe", "-x", "c++", "-O2", "-static"
             ])
-            digest = self.file_cacher.put_file_from_path(
-                manager_exe,
-                "Manager for task %s" % name)
-            args["managers"]["manager"] = Manager("manager", digest)
+            compilations.append(manager_compilation)
+
+        digests = self._put_files_from_paths([
+            (os.path.join(graders_dir, grader_name),
+             "Manager for task %s" % name)
+            for grader_name in graders_list])
+        for grader_name, digest in zip(graders_list, digests):
+            grader_name = os.path.basename(grader_name)
+            if task_type == 'Communication' \
+                    and os.path.splitext(grader_name)[0] == 'grader':
+                grader_name = 'stub' + os.path.splitext(grader_name)[1]
+            args["managers"][grader_name] = Manager(grader_name, digest)
 
         # Testcases
         args["testcases"] = {}
 
-        for codename in testcase_codenames:
-            infile = os.path.join(testcases_dir, "%s.in" % codename)
-            outfile = os.path.join(testcases_dir, "%s.out" % codename)
-            if not os.path.exists(outfile):
+        # The task name is formatted in the descriptions only once (it
+        # is escaped as it could contain a '%').
+        escaped_name = name.replace("%", "%%")
+        input_description = "Input %%s for task %s" % escaped_name
+        output_description = "Output %%s for task %s" % escaped_name
+        for codename, _ in testcase_inputs:
+            if codename not in testcase_outputs:
                 logger.critical(
                     'Could not find the output file for testcase %s', codename)
                 logger.critical('Aborting...')
+                for compilation in compilations:
+                    compilation.wait()
                 return
 
+        def put_testcase(codename_infile):
+            codename, infile = codename_infile
             input_digest = self.file_cacher.put_file_from_path(
-                infile,
-                "Input %s for task %s" % (codename, name))
+                infile, input_description % codename)
             output_digest = self.file_cacher.put_file_from_path(
-                outfile,
-                "Output %s for task %s" % (codename, name))
+                infile[:-3] + ".out", output_description % codename)
+            return codename, input_digest, output_digest
+
+        # Each testcase is added as soon as its files are stored, in
+        # whatever order the uploads complete.
+        pool = gevent.pool.Pool(TpsTaskLoader.MAX_CONCURRENT_UPLOADS)
+        for codename, input_digest, output_digest in \
+                pool.imap_unordered(put_testcase, testcase_inputs):
             # if codename.split('-')[0] != '0':   # We don't need sample testcase in CMS
             testcase = Testcase(codename, True,
                                 input_digest, output_digest)
             args["testcases"][codename] = testcase
 
+        # Checker and manager executables
+        if checker_compilation is not None:
+            checker_compilation.wait()
+            digest = self.file_cacher.put_file_from_path(
+                checker_exe,
+                "Manager for task %s" % name)
+            args["managers"]['checker'] = Manager("checker", digest)
+
+        if manager_compilation is not None:
+            manager_compilation.wait()
+            digest = self.file_cacher.put_file_from_path(
+                manager_exe,
+                "Manager for task %s" % name)
+            args["managers"]["manager"] = Manager("manager", digest)
+
         # Score Type
         subtasks_json_src = os.path.join(self.path, 'subtasks.json')
         if not os.path.exists(subtasks_json_src):
@@ -374,47 +592,49 @@ class TpsTaskLoader(TaskLoader):
             args["score_type_parameters"] = 100 / number_tests
         else:
             args["score_type"] = "GroupMin"
-            parsed_data = []
-            subtask_no = -1
             mapping_src = os.path.join(self.path, 'tests', 'mapping')
-            with open(subtasks_json_src, 'rt', encoding='utf-8') as json_file:
-                subtasks_data = json.load(json_file)
+            subtasks_data = _load_json(subtasks_json_src)
 
             use_mapping = os.path.exists(mapping_src)
             if use_mapping:
-                mapping_data = {}
-                for subtask in subtasks_data['subtasks']:
-                    mapping_data[subtask] = []
+                # For each subtask, the prefixes of its testcases.
+                mapping_prefixes = defaultdict(set)
                 with open(mapping_src, 'rt', encoding='utf-8') as mapping_file:
                     for row in mapping_file:
-                        row = row.strip().split(' ')
-                        if len(row) == 2:
-                            mapping_data[row[0]].append(row[1])
+                        # Rows are "<subtask> <testcase>", ignore others.
+                        subtask, sep, testcase = row.strip().partition(' ')
+                        if sep and ' ' not in testcase:
+                            mapping_prefixes[subtask].add(
+                                testcase.partition('-')[0])
+
+            add_optional_name = data.get('add_optional_name', False)
+
+            # The regex matching the testcases whose codename starts with
+            # a given prefix (the part before the first dash).
+            if task_type == 'OutputOnly':
+                codename_format = '^%s'
+            else:
+                codename_format = '^%s\\-'
 
-            add_optional_name = data['add_optional_name'] if 'add_optional_name' in data else False
+            def get_testcases(subtask, subtask_data):
+                if not use_mapping:
+                    return subtask_data["regex"]
+                codenames = sorted(codename_format % prefix
+                                   for prefix in mapping_prefixes[subtask])
+                return "|".join(codenames) or '|NO_TESTCASES_AVAILABLE'
 
             subtasks = sorted(subtasks_data['subtasks'].items(), key = lambda subtask: subtask[1]['index'])
-            for subtask, subtask_data in subtasks:
-                subtask_no += 1
-                score = int(subtask_data["score"])
-                if use_mapping:
-                    if data["type"] == 'OutputOnly':
-                        codenames = sorted(list(set('^' + testcase.split('-')[0] for testcase in mapping_data[subtask])))
+            parsed_data = [
+                [int(subtask_data["score"]),
+                 get_testcases(subtask, subtask_data)]
+                for subtask, subtask_data in subtasks]
+            if add_optional_name:
+                for subtask_no, subtask_params in enumerate(parsed_data):
+                    if subtask_no == 0 and subtask_params[0] == 0:
+                    #     continue   # We don't need sample testcase in CMS
+                        subtask_params.append("Samples")
                     else:
-                        codenames = sorted(list(set('^' + testcase.split('-')[0] + '\\-' for testcase in mapping_data[subtask])))
-                    testcases = "|".join(codenames)
-                    if testcases == '':
-                        testcases = '|NO_TESTCASES_AVAILABLE'
-                else:
-                    testcases = subtask_data["regex"]
-                optional_name = "Subtask %d" % subtask_no
-                if subtask_no == 0 and score == 0:
-                #     continue   # We don't need sample testcase in CMS
-                    optional_name = "Samples"
-                if add_optional_name:
-                    parsed_data.append([score, testcases, optional_name])
-                else:
-                    parsed_data.append([score, testcases])
+                        subtask_params.append("Subtask %d" % subtask_no)
             args["score_type_parameters"] = parsed_data
 
         dataset = Dataset(**args)
@@ -81,6 +81,24 @@ class TestPriorityQueue(unittest.TestCase):
         with self.assertRaises(LookupError):
             self.queue.pop()
 
+    def test_pop_all(self):
+        """Verify that all items are extracted at once, in order."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(10))
+        self.queue.push(self.item_c, PriorityQueue.PRIORITY_MEDIUM,
+                        timestamp=make_datetime(5))
+        self.queue.push(self.item_d, PriorityQueue.PRIORITY_HIGH)
+
+        entries = self.queue.pop_all()
+        self.assertEqual([entry.item for entry in entries],
+                         [self.item_d, self.item_c, self.item_b, self.item_a])
+        self.assertTrue(self.queue.empty())
+        self.assertTrue(self.queue._verify())
+
+        with self.assertRaises(LookupError):
+            self.queue.pop_all()
+
     def test_set_priority(self):
         """Test that priority get changed and item moved."""
         self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
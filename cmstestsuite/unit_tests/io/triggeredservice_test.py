@@ -179,6 +179,20 @@ class TestTriggeredService(unittest.TestCase):
         # Just one call to the batch executor.
         self.assertEqual(batch_notifier.get_notifications(), 1)
 
+    def test_batch_limit_read_once(self):
+        """Test that the batch size is asked once per batch."""
+        self.setUpService()
+        batch_notifier = Notifier()
+        executor = FakeBatchExecutor(batch_notifier)
+        self.service.add_executor(executor)
+        with patch.object(executor, "max_operations_per_batch",
+                          return_value=16) as max_operations_per_batch:
+            self.service.enqueue(FakeQueueItem('op 0'))
+            self.service.enqueue(FakeQueueItem('op 1'))
+            gevent.sleep(0.01)
+        self.assertEqual(batch_notifier.get_notifications(), 1)
+        self.assertEqual(max_operations_per_batch.call_count, 1)
+
 
 if __name__ == "__main__":
     unittest.main()
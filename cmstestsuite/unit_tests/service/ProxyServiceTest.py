@@ -27,6 +27,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
+import six
 
 # We enable monkey patching to make many libraries gevent-friendly
 # (for instance, urllib3, used by requests)
@@ -36,12 +37,15 @@ gevent.monkey.patch_all()  # noqa
 import unittest
 
 import gevent
-from mock import patch, PropertyMock
+from mock import Mock, patch, PropertyMock
 
 # Needs to be first to allow for monkey patching the DB connection string.
 from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
 
-from cms.service.ProxyService import ProxyService
+from cms import config
+from cms.io import QueueEntry
+from cms.service.ProxyService import ProxyExecutor, ProxyOperation, \
+    ProxyService
 from cmscommon.constants import SCORE_MODE_MAX
 
 
@@ -57,7 +61,7 @@ class TestProxyService(DatabaseMixin, unittest.TestCase):
         self.score_type.max_score = 100
         self.score_type.ranking_headers = ["100"]
 
-        patcher = patch("requests.put")
+        patcher = patch("requests.Session.put")
         self.requests_put = patcher.start()
         self.addCleanup(patcher.stop)
         self.requests_put.return_value.status_code = 200
@@ -117,6 +121,144 @@ class TestProxyService(DatabaseMixin, unittest.TestCase):
         self.assertTrue(urls[4].endswith("submissions/"))
         self.assertTrue(urls[5].endswith("subchanges/"))
 
+    @patch.object(ProxyExecutor, "FAILURE_WAIT", 0.01)
+    def test_startup_failure(self):
+        """Test that data not sent because of a failure is resent."""
+        failure = Mock(status_code=500)
+        success = Mock(status_code=200)
+        self.requests_put.return_value = None
+        self.requests_put.side_effect = \
+            lambda url, *args, **kwargs: failure \
+            if self.requests_put.call_count == 1 else success
+
+        ProxyService(0, self.contest.id)
+
+        gevent.sleep(0.1)
+
+        urls = [args[0] for args, _ in self.requests_put.call_args_list]
+
+        self.assertTrue(urls[0].endswith("contests/"))
+        self.assertEqual(sum(1 for url in urls if url.endswith("contests/")),
+                         2)
+        self.assertTrue(urls[-2].endswith("submissions/"))
+        self.assertTrue(urls[-1].endswith("subchanges/"))
+
+    @patch.object(ProxyService, "MISSING_OPERATIONS_CHUNK_SIZE", 1)
+    def test_missing_operations_few(self):
+        """Test that the few submissions not sent yet are found."""
+        service = ProxyService(0, self.contest.id)
+        gevent.sleep(0.1)
+
+        results = [self.new_sr_scored() for _ in range(2)]
+        self.session.commit()
+        submission_ids = [result.submission_id for result in results]
+
+        # Two submissions, each with a score and a subchange.
+        self.assertEqual(service._missing_operations(), 4)
+        for submission_id in submission_ids:
+            self.assertIn(submission_id, service.scores_sent_to_rankings)
+        self.assertEqual(service._missing_operations(), 0)
+
+        # Let the operations be sent while the requests are mocked.
+        gevent.sleep(0.1)
+
+
+class TestProxyExecutor(unittest.TestCase):
+
+    @patch.object(config, "max_unsent_submissions_per_ranking", 2)
+    def test_drop_oldest(self):
+        """Test that the oldest unsent submissions are dropped."""
+        executor = ProxyExecutor("http://localhost:8890/")
+        submissions = executor._data[ProxyExecutor.SUBMISSION_TYPE]
+        subchanges = executor._data[ProxyExecutor.SUBCHANGE_TYPE]
+        for i in range(1, 4):
+            submissions["%d" % i] = {"time": i}
+            subchanges["%ds" % i] = {"submission": "%d" % i, "time": i}
+        subchanges["3t"] = {"submission": "3", "time": 4, "token": True}
+
+        executor._drop_oldest()
+
+        self.assertEqual(list(submissions), ["2", "3"])
+        self.assertEqual(list(subchanges), ["3s", "3t"])
+
+    def test_independent_types_sent_concurrently(self):
+        """Test that contests and teams are sent at the same time."""
+        events = list()
+
+        def put(url, *args, **kwargs):
+            name = url.rsplit("/", 2)[-2]
+            events.append(("start", name))
+            gevent.sleep(0.01)
+            events.append(("end", name))
+            return Mock(status_code=200)
+
+        executor = ProxyExecutor("http://localhost:8890/")
+        operations = [
+            ProxyOperation(ProxyExecutor.CONTEST_TYPE, {"c": {}}),
+            ProxyOperation(ProxyExecutor.TEAM_TYPE, {"t": {}}),
+            ProxyOperation(ProxyExecutor.TASK_TYPE, {"k": {}})]
+        with patch("requests.Session.put", side_effect=put):
+            executor.execute([QueueEntry(operation, 0, 0, i)
+                              for i, operation in enumerate(operations)])
+
+        six.assertCountEqual(self, events[:2],
+                             [("start", "contests"), ("start", "teams")])
+        six.assertCountEqual(self, events[2:4],
+                             [("end", "contests"), ("end", "teams")])
+        self.assertEqual(events[4:], [("start", "tasks"), ("end", "tasks")])
+
+    @patch.object(ProxyExecutor, "FAILURE_WAIT", 0.01)
+    def test_rejected_data_dropped(self):
+        """Test that data refused by the ranking is not sent again."""
+        def put(url, body, *args, **kwargs):
+            if url.endswith("submissions/") and "bad" in body:
+                return Mock(status_code=400)
+            return Mock(status_code=200)
+
+        executor = ProxyExecutor("http://localhost:8890/")
+        submissions = executor._data[ProxyExecutor.SUBMISSION_TYPE]
+        bad = ProxyOperation(ProxyExecutor.SUBMISSION_TYPE, {"bad": {}})
+        good = ProxyOperation(ProxyExecutor.SUBMISSION_TYPE, {"good": {}})
+        with patch("requests.Session.put", side_effect=put) as put_mock:
+            executor.execute([QueueEntry(bad, 0, 0, 0)])
+            self.assertEqual(len(submissions), 0)
+            executor.execute([QueueEntry(good, 0, 0, 1)])
+
+        bodies = [args[1] for args, _ in put_mock.call_args_list]
+        self.assertEqual(len(bodies), 2)
+        self.assertNotIn("bad", bodies[1])
+        self.assertIn("good", bodies[1])
+        self.assertEqual(len(submissions), 0)
+
+    @patch.object(ProxyExecutor, "FAILURE_WAIT", 0.01)
+    def test_unauthorized_data_kept(self):
+        """Test that data is kept if the ranking refuses the credentials."""
+        executor = ProxyExecutor("http://localhost:8890/")
+        submissions = executor._data[ProxyExecutor.SUBMISSION_TYPE]
+        operation = ProxyOperation(ProxyExecutor.SUBMISSION_TYPE, {"s": {}})
+        # Another operation arrives while waiting to retry, so that
+        # execute returns instead of retrying forever.
+        with patch("requests.Session.put",
+                   return_value=Mock(status_code=401)), \
+                patch.object(executor._operation_queue, "empty",
+                             return_value=False):
+            executor.execute([QueueEntry(operation, 0, 0, 0)])
+
+        self.assertEqual(list(submissions), ["s"])
+
+    @patch.object(ProxyExecutor, "FAILURE_WAIT", 0.01)
+    def test_unexpected_error_drops_data(self):
+        """Test that data that cannot be sent at all is not kept."""
+        executor = ProxyExecutor("http://localhost:8890/")
+        # Not JSON-serializable.
+        operation = ProxyOperation(ProxyExecutor.CONTEST_TYPE,
+                                   {"c": object()})
+        with patch("requests.Session.put") as put_mock:
+            executor.execute([QueueEntry(operation, 0, 0, 0)])
+
+        put_mock.assert_not_called()
+        self.assertTrue(all(len(data) == 0 for data in executor._data))
+
 
 if __name__ == "__main__":
     unittest.main()
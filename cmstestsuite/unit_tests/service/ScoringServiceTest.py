@@ -130,6 +130,59 @@ class TestScoringService(DatabaseMixin, unittest.TestCase):
                              [(sr_a.submission_id, sr_a.dataset_id),
                               (sr_b.submission_id, sr_b.dataset_id)])
 
+    def test_new_evaluation_two_one_missing(self):
+        """An error on a submission doesn't prevent scoring the others.
+
+        """
+        sr = self.new_sr_to_score()
+        self.session.commit()
+
+        service = ScoringService(0)
+        service.new_evaluation(unique_long_id(), sr.dataset_id)
+        service.new_evaluation(sr.submission_id, sr.dataset_id)
+
+        gevent.sleep(0.1)  # Needed to trigger the score loop.
+
+        # Asserts that compute_score was called and the score stored.
+        six.assertCountEqual(self, self.call_args,
+                             [(sr.submission_id, sr.dataset_id)])
+        self.session.expire(sr)
+        self.assertEqual(sr.score, self.score_info[0])
+
+    def test_new_evaluation_two_one_db_error(self):
+        """A database error on a submission doesn't lose the others.
+
+        """
+        sr_a = self.new_sr_to_score()
+        sr_b = self.new_sr_to_score()
+        self.session.commit()
+        # Load the ids now, so that the two operations are enqueued
+        # without yielding, and scored in the same batch.
+        ids_a = (sr_a.submission_id, sr_a.dataset_id)
+        ids_b = (sr_b.submission_id, sr_b.dataset_id)
+
+        def compute_score(sr):
+            self.call_args.append((sr.submission_id, sr.dataset_id))
+            if sr.submission_id == ids_a[0]:
+                # Not a number: storing it fails.
+                return ("wrong",) + self.score_info[1:]
+            return self.score_info
+        self.score_type.compute_score.side_effect = compute_score
+
+        service = ScoringService(0)
+        service.new_evaluation(*ids_a)
+        service.new_evaluation(*ids_b)
+
+        gevent.sleep(0.1)  # Needed to trigger the score loop.
+
+        # Asserts that both were scored in the same batch, and that
+        # the score of the other submission was stored.
+        six.assertCountEqual(self, self.call_args, [ids_a, ids_b])
+        self.session.expire(sr_a)
+        self.session.expire(sr_b)
+        self.assertIsNone(sr_a.score)
+        self.assertEqual(sr_b.score, self.score_info[0])
+
     def test_new_evaluation_already_scored(self):
         """One submission is not re-scored if already scored.
 